@@ -1,20 +1,55 @@
-import requests
-import concurrent.futures
+import httpx
+import asyncio
 import time
 import sys
 import configparser
 import json
 import os
-import urllib3
 import argparse
+import functools
+import math
+import mmap
+import sqlite3
+import email.utils
+from datetime import datetime, timezone
+from contextlib import closing
 
-# Disable warnings
-urllib3.disable_warnings(urllib3.exceptions.NotOpenSSLWarning)
+try:
+    # Faster decoding of API responses, if installed
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
 # Files for data storage
 DOMAINS_FILE = 'domains.txt'
 CONFIG_FILE = 'api_config.json'
 RESULTS_FILE = 'results.txt'
+RESULTS_DB = 'results.sqlite'
+RESULTS_DB_VERSION = 1
+
+API_URL = 'https://api.cloudflare.com/client/v4'
+MAX_CONCURRENT_REQUESTS = 32  # For all accounts, to stay within Cloudflare rate limits
+MAX_RETRIES = 5
+BACKOFF_FACTOR = 0.5  # Retry delays: 0.5, 1, 2, 4, 8 seconds
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+MAX_RETRY_DELAY = 60  # Seconds, upper bound for backoff and Retry-After
+REQUEST_TIMEOUT = 30  # Seconds
+KEEPALIVE_EXPIRY = 60  # Seconds an idle connection is kept for reuse
+ZONES_CACHE_TTL = 600  # Seconds to reuse zones list of an account in domain search
+RECORDS_CACHE_TTL = 60  # Seconds to reuse A records of a zone in domain search
+
+# Event loop and HTTP session reused between actions to keep connections alive
+_loop = None
+_session = None
+_request_slots = None
+
+# API responses reused by domain search: key -> (expiry time, value)
+_zones_cache = {}
+_zone_lookup_cache = {}
+_records_cache = {}
+
+# (mtime, domain -> line offset) of results.txt, for lookups without SQLite index
+_results_file_index = None
 
 def load_api_configs():
     """Loading API configurations from JSON file"""
@@ -25,159 +60,424 @@ def load_api_configs():
         print(f"File {CONFIG_FILE} not found!")
         return {}
 
-def get_all_zones(api_token):
-    """Getting ALL zones (domains) in the account with pagination"""
-    headers = {
-        'Authorization': f'Bearer {api_token}',
-        'Content-Type': 'application/json'
-    }
+def cache_get(cache, key):
+    """Getting value from TTL cache, None if missing or expired"""
+    entry = cache.get(key)
+    if entry is None:
+        return None
+    if entry[0] <= time.monotonic():
+        del cache[key]
+        return None
+    return entry[1]
 
-    all_zones = []
-    page = 1
-    per_page = 50  # Maximum number of domains per page in Cloudflare API
+def cache_set(cache, key, value, ttl):
+    """Storing value in TTL cache"""
+    cache[key] = (time.monotonic() + ttl, value)
 
-    while True:
-        url = f'https://api.cloudflare.com/client/v4/zones?page={page}&per_page={per_page}'
+@functools.lru_cache(maxsize=None)
+def get_auth_headers(api_token):
+    """Building request headers for the account token, once per token"""
+    return {'Authorization': f'Bearer {api_token}'}
+
+def get_retry_delay(response, attempt):
+    """Getting seconds to wait before retry, from Retry-After header if it is valid"""
+    backoff = BACKOFF_FACTOR * 2 ** attempt
+    delay = backoff
+    # Cloudflare tells how long to wait when rate limiting, in seconds or as HTTP date
+    retry_after = response.headers.get('Retry-After')
+    if retry_after:
         try:
-            response = requests.get(url, headers=headers)
-            response.raise_for_status()
-            data = response.json()
-            
-            if data['success']:
-                zones = data['result']
-                all_zones.extend(zones)
-                
-                # Check if there are more pages
-                total_pages = data['result_info'].get('total_pages', 0)
-                
-                if page >= total_pages:
-                    break
-                
-                page += 1
-            else:
-                print("Failed to get zones list")
-                break
-        except requests.exceptions.RequestException as e:
-            print(f"Error getting zones list: {e}")
-            break
+            delay = float(retry_after)
+        except ValueError:
+            try:
+                retry_at = email.utils.parsedate_to_datetime(retry_after)
+                delay = (retry_at - datetime.now(timezone.utc)).total_seconds()
+            except (TypeError, ValueError):
+                pass
+    if not math.isfinite(delay):
+        delay = backoff
+    return min(max(delay, 0), MAX_RETRY_DELAY)
+
+async def get_json(session, url, headers, params=None):
+    """Getting JSON response, retrying rate limited and failed requests with backoff"""
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            async with _request_slots:
+                response = await session.get(url, headers=headers, params=params)
+            if response.status_code not in RETRY_STATUSES or attempt == MAX_RETRIES:
+                response.raise_for_status()
+                try:
+                    return json_loads(response.content)
+                except ValueError as e:
+                    # Reported like other HTTP errors, so callers skip just this response
+                    raise httpx.DecodingError(f"Invalid JSON in response: {e}", request=response.request) from e
+            delay = get_retry_delay(response, attempt)
+            reason = f"HTTP {response.status_code}"
+        except httpx.TransportError as e:
+            if attempt == MAX_RETRIES:
+                raise
+            delay = min(BACKOFF_FACTOR * 2 ** attempt, MAX_RETRY_DELAY)
+            reason = e.__class__.__name__
+        print(f"Request failed ({reason}), retrying in {delay:g} s")
+        await asyncio.sleep(delay)
+
+async def get_all_zones(session, api_token):
+    """Getting ALL zones (domains) in the account with pagination, None if listing failed"""
+    headers = get_auth_headers(api_token)
+    per_page = 50  # Maximum number of domains per page in Cloudflare API
+
+    def zones_url(page):
+        return f'{API_URL}/zones?page={page}&per_page={per_page}'
+
+    # First page tells how many pages there are
+    try:
+        data = await get_json(session, zones_url(1), headers)
+    except httpx.HTTPError as e:
+        print(f"Error getting zones list: {e}")
+        return None
 
+    if not data['success']:
+        print("Failed to get zones list")
+        return None
+
+    all_zones = list(data['result'])
+    total_pages = data['result_info'].get('total_pages', 0)
+
+    # Fetching remaining pages concurrently, keeping page order
+    pages = await asyncio.gather(*[
+        get_json(session, zones_url(page), headers)
+        for page in range(2, total_pages + 1)
+    ], return_exceptions=True)
+
+    complete = True
+    for data in pages:
+        if isinstance(data, httpx.HTTPError):
+            print(f"Error getting zones list: {data}")
+            complete = False
+        elif isinstance(data, BaseException):
+            raise data
+        elif data['success']:
+            all_zones.extend(data['result'])
+        else:
+            print("Failed to get zones list")
+            complete = False
+
+    if not complete:
+        return None
+
+    cache_set(_zones_cache, api_token, all_zones, ZONES_CACHE_TTL)
     return all_zones
 
-def process_domains_for_account(api_token, account_name):
-    """Processing domains for a specific account"""
-    zones = get_all_zones(api_token)
+async def find_zone(session, api_token, domain):
+    """Getting zone of the domain in the account, None if the account does not host it"""
+    zones = cache_get(_zones_cache, api_token)
+    if zones is not None:
+        return next((zone for zone in zones if zone['name'] == domain), None)
+
+    # Letting Cloudflare look the zone up instead of listing all zones,
+    # an empty dict marks that the account does not host the domain
+    zone = cache_get(_zone_lookup_cache, (api_token, domain))
+    if zone is None:
+        url = f'{API_URL}/zones'
+        data = await get_json(session, url, get_auth_headers(api_token), params={'name': domain})
+        if not data['success']:
+            # Not cached, a failed lookup does not mean the domain is not hosted
+            return None
+        zone = data['result'][0] if data['result'] else {}
+        cache_set(_zone_lookup_cache, (api_token, domain), zone, ZONES_CACHE_TTL)
+    return zone or None
+
+async def fetch_a_records(session, headers, zone_id, domain):
+    """Getting IPs from the A records of the zone apex"""
+    # Letting Cloudflare filter the apex records instead of scanning the zone
+    url = f'{API_URL}/zones/{zone_id}/dns_records'
+    data = await get_json(session, url, headers, params={'type': 'A', 'name': domain, 'per_page': 100})
+
+    if not data['success']:
+        return []
+    return [record['content'] for record in data['result']]
+
+async def get_cached_a_records(session, headers, zone_id, domain):
+    """Getting IPs from the A records of the zone apex, reusing recent response"""
+    ips = cache_get(_records_cache, zone_id)
+    if ips is None:
+        ips = await fetch_a_records(session, headers, zone_id, domain)
+        cache_set(_records_cache, zone_id, ips, RECORDS_CACHE_TTL)
+    return ips
+
+async def process_domains_for_account(session, api_token, account_name, write_results, known_zones=None):
+    """Processing domains for a specific account, passing results of each zone to writer
+
+    known_zones maps zone id to (modified_on, IPs) of the previous export,
+    zones that were not modified since then are not requested again.
+    Returns False if zones of the account could not be listed.
+    """
+    zones = await get_all_zones(session, api_token)
+    if zones is None:
+        print(f"Failed to list domains in account {account_name}")
+        return False
     print(f"Found domains in account {account_name}: {len(zones)}")
-    
-    account_results = []
-    
-    for zone in zones:
+
+    headers = get_auth_headers(api_token)
+
+    async def process_zone(zone):
         domain = zone['name']
-        zone_id = zone['id']
-        
-        headers = {
-            'Authorization': f'Bearer {api_token}',
-            'Content-Type': 'application/json'
-        }
-        
-        # Getting A records
-        url = f'https://api.cloudflare.com/client/v4/zones/{zone_id}/dns_records?type=A'
+        known = known_zones.get(zone['id']) if known_zones else None
+        if known and known[0] == zone.get('modified_on'):
+            write_results(zone, account_name, known[1])
+            return
         try:
-            response = requests.get(url, headers=headers)
-            response.raise_for_status()
-            data = response.json()
-            
-            if data['success']:
-                records = data['result']
-                for record in records:
-                    if record['type'] == 'A' and (record['name'] == '@' or record['name'] == domain):
-                        result = f"{domain};{record['content']};{account_name}\n"
-                        account_results.append(result)
-        
-        except requests.exceptions.RequestException as e:
+            ips = await fetch_a_records(session, headers, zone['id'], domain)
+        except httpx.HTTPError as e:
             print(f"Error getting records for {domain}: {e}")
-    
-    return account_results
+            if known:
+                # Keeping previous IPs with previous modified_on, so the zone is requested next time
+                write_results(dict(zone, modified_on=known[0]), account_name, known[1])
+            return
+        write_results(zone, account_name, ips)
 
-def export_dns_records(api_configs):
-    """Export DNS records for all accounts"""
-    all_results = []
-    
-    # Using multithreading for processing accounts
-    with concurrent.futures.ThreadPoolExecutor(max_workers=len(api_configs)) as executor:
-        # Preparing tasks
-        future_to_account = {
-            executor.submit(process_domains_for_account, account_data['token'], account_name): account_name 
-            for account_name, account_data in api_configs.items()
-        }
-        
-        # Collecting results
-        for future in concurrent.futures.as_completed(future_to_account):
-            account_results = future.result()
-            all_results.extend(account_results)
-    
-    # Writing results to file
-    with open(RESULTS_FILE, 'w') as f:
-        f.write("Domain;IP;Account\n")
-        f.writelines(all_results)
+    # Getting A records for all zones concurrently
+    await asyncio.gather(*[process_zone(zone) for zone in zones])
+    return True
+
+def make_session():
+    """Creating HTTP session with a keep-alive connection pool"""
+    # Requests are multiplexed over a few HTTP/2 connections (needs httpx[http2]),
+    # kept alive between interactive lookups so they skip DNS and TLS handshakes
+    limits = httpx.Limits(
+        max_connections=4,
+        max_keepalive_connections=4,
+        keepalive_expiry=KEEPALIVE_EXPIRY
+    )
+    # Authorization differs per account, so only common headers are set here
+    return httpx.AsyncClient(
+        http2=True,
+        limits=limits,
+        timeout=REQUEST_TIMEOUT,
+        headers={'Content-Type': 'application/json'}
+    )
+
+async def get_session():
+    """Getting HTTP session shared by all Cloudflare API calls"""
+    global _session, _request_slots
+    if _session is None or _session.is_closed:
+        _session = make_session()
+        # Limit concurrent requests of all accounts together
+        _request_slots = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    return _session
+
+def run(coro):
+    """Running coroutine on the event loop kept for the whole program"""
+    global _loop
+    if _loop is None or _loop.is_closed():
+        _loop = asyncio.new_event_loop()
+    return _loop.run_until_complete(coro)
+
+def close_session():
+    """Closing shared HTTP session and event loop"""
+    global _session, _loop, _request_slots
+    if _loop is None or _loop.is_closed():
+        return
+    if _session is not None and not _session.is_closed:
+        _loop.run_until_complete(_session.aclose())
+    _session = None
+    _request_slots = None
+    _loop.close()
+    _loop = None
+
+async def export_dns_records_async(api_configs, write_results, known_zones=None):
+    """Collecting DNS records for all accounts concurrently, returning accounts that failed"""
+    session = await get_session()
+    account_names = list(api_configs)
+    listed = await asyncio.gather(*[
+        process_domains_for_account(session, api_configs[account_name]['token'], account_name, write_results, known_zones)
+        for account_name in account_names
+    ])
+    return [account_name for account_name, ok in zip(account_names, listed) if not ok]
+
+class ExportError(Exception):
+    """Export could not list all zones, previous results are kept"""
+
+def export_dns_records(api_configs, incremental=False):
+    """Export DNS records for all accounts, only for modified zones if incremental"""
+    # Writing results to temporary file and SQLite index as zones are processed
+    tmp_results_file = f'{RESULTS_FILE}.tmp'
+    try:
+        with closing(open_results_db()) as conn, conn:
+            with open(tmp_results_file, 'wb', buffering=1 << 20) as f:
+                f.write(b"Domain;IP;Account\n")
+                known_zones = load_known_zones(conn) if incremental else None
+                conn.execute('DELETE FROM zones')
+                conn.execute('DELETE FROM dns')
+
+                def write_results(zone, account_name, ips):
+                    domain = zone['name']
+                    # One write of the joined lines of the zone
+                    prefix, suffix = f"{domain};".encode(), f";{account_name}\n".encode()
+                    f.write(b"".join(b"%s%s%s" % (prefix, ip.encode(), suffix) for ip in ips))
+                    conn.execute('INSERT OR REPLACE INTO zones VALUES (?, ?)', (zone['id'], zone.get('modified_on')))
+                    conn.executemany(
+                        'INSERT INTO dns VALUES (?, ?, ?, ?)',
+                        [(zone['id'], domain, ip, account_name) for ip in ips]
+                    )
+
+                failed_accounts = run(export_dns_records_async(api_configs, write_results, known_zones))
+                if failed_accounts:
+                    # Rolling back SQLite transaction, results.txt is not replaced
+                    raise ExportError(f"could not list domains in accounts: {', '.join(failed_accounts)}")
+
+            # Replacing results.txt right before the SQLite transaction commits,
+            # so a failed run keeps the previous export in both
+            os.replace(tmp_results_file, RESULTS_FILE)
+    except ExportError as e:
+        print(f"DNS records export failed, {e}. Previous results are kept in {RESULTS_FILE}")
+        return
+    finally:
+        if os.path.exists(tmp_results_file):
+            os.remove(tmp_results_file)
+
+    find_in_results_db.cache_clear()
     
     print(f"DNS records export completed. Results saved in {RESULTS_FILE}")
 
-def get_domain_ip(domain, api_configs):
-    """Getting IP for a specific domain"""
-    # First searching in local results.txt file
-    try:
-        with open(RESULTS_FILE, 'r') as f:
+def open_results_db():
+    """Opening SQLite index of exported results for fast domain lookups"""
+    conn = sqlite3.connect(RESULTS_DB)
+    if conn.execute('PRAGMA user_version').fetchone()[0] < RESULTS_DB_VERSION:
+        # Index is rebuilt on every export, so older layouts are just dropped
+        conn.executescript(f'''
+            DROP TABLE IF EXISTS dns;
+            DROP TABLE IF EXISTS zones;
+            CREATE TABLE zones(zone_id TEXT PRIMARY KEY, modified_on TEXT);
+            CREATE TABLE dns(zone_id TEXT, domain TEXT COLLATE NOCASE, ip TEXT, account TEXT);
+            CREATE INDEX dns_domain ON dns(domain);
+            PRAGMA user_version = {RESULTS_DB_VERSION};
+        ''')
+    return conn
+
+def load_known_zones(conn):
+    """Getting zone id -> (modified_on, IPs) of the previous export"""
+    known_zones = {
+        zone_id: (modified_on, [])
+        for zone_id, modified_on in conn.execute('SELECT zone_id, modified_on FROM zones')
+    }
+    for zone_id, ip in conn.execute('SELECT zone_id, ip FROM dns ORDER BY rowid'):
+        if zone_id in known_zones:
+            known_zones[zone_id][1].append(ip)
+    return known_zones
+
+@functools.lru_cache(maxsize=4096)
+def find_in_results_db(domain):
+    """Getting (IP, account) for a lowercased domain from SQLite index"""
+    with closing(sqlite3.connect(f'file:{RESULTS_DB}?mode=ro', uri=True)) as conn:
+        # First A record of a domain, same as results.txt lookup
+        return conn.execute(
+            'SELECT ip, account FROM dns WHERE domain = ? ORDER BY rowid LIMIT 1', (domain,)
+        ).fetchone()
+
+def get_results_file_index():
+    """Getting offsets of domain lines in results.txt, rebuilt when the file changes"""
+    global _results_file_index
+    mtime = os.stat(RESULTS_FILE).st_mtime_ns
+    if _results_file_index is None or _results_file_index[0] != mtime:
+        offsets = {}
+        with open(RESULTS_FILE, 'rb') as f, \
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
             # Skip header
-            next(f)
-            for line in f:
-                parts = line.strip().split(';')
-                if len(parts) >= 2 and parts[0].lower() == domain.lower():
-                    # Return format: domain - IP (Account: account)
-                    account = parts[2] if len(parts) > 2 else "Unknown account"
-                    return f"{domain} - {parts[1]} (Account: {account})"
+            mm.readline()
+            offset = mm.tell()
+            for line in iter(mm.readline, b''):
+                domain = line.split(b';', 1)[0].strip().decode().lower()
+                # Keeping the first A record of a domain
+                offsets.setdefault(domain, offset)
+                offset = mm.tell()
+        _results_file_index = (mtime, offsets)
+    return _results_file_index[1]
+
+def find_in_results_file(domain):
+    """Getting (IP, account) for a domain from local results.txt file"""
+    try:
+        offset = get_results_file_index().get(domain.lower())
+        if offset is None:
+            return None
+        # Offsets are in bytes, so the line is read in binary mode
+        with open(RESULTS_FILE, 'rb') as f:
+            f.seek(offset)
+            parts = f.readline().decode('utf-8').strip().split(';')
+        if len(parts) >= 2:
+            account = parts[2] if len(parts) > 2 else "Unknown account"
+            return parts[1], account
     except FileNotFoundError:
         print(f"File {RESULTS_FILE} not found. Searching via API.")
     except Exception as e:
         print(f"Error reading {RESULTS_FILE}: {e}")
+    return None
 
-    # If not found in local file, search via API
-    for account_name, account_data in api_configs.items():
-        api_token = account_data['token']
-        
-        zones = get_all_zones(api_token)
-        
-        for zone in zones:
-            if zone['name'] == domain:
-                zone_id = zone['id']
-                
-                headers = {
-                    'Authorization': f'Bearer {api_token}',
-                    'Content-Type': 'application/json'
-                }
-                
-                url = f'https://api.cloudflare.com/client/v4/zones/{zone_id}/dns_records?type=A'
-                try:
-                    response = requests.get(url, headers=headers)
-                    response.raise_for_status()
-                    data = response.json()
-                    
-                    if data['success']:
-                        records = data['result']
-                        for record in records:
-                            if record['type'] == 'A' and (record['name'] == '@' or record['name'] == domain):
-                                return f"{domain} - {record['content']} (Account: {account_name})"
-                except requests.exceptions.RequestException:
-                    pass
-    
+async def search_domain_ip_in_account(session, domain, account_name, api_token):
+    """Searching IP for a specific domain in one account via API"""
+    try:
+        zone = await find_zone(session, api_token, domain)
+        if zone is None:
+            return None
+        headers = get_auth_headers(api_token)
+        ips = await get_cached_a_records(session, headers, zone['id'], domain)
+    except httpx.HTTPError:
+        return None
+    if ips:
+        return f"{domain} - {ips[0]} (Account: {account_name})"
     return None
 
+async def search_domain_ip_via_api(domain, api_configs):
+    """Searching IP for a specific domain in all accounts concurrently, first hit wins"""
+    session = await get_session()
+    pending = {
+        asyncio.create_task(search_domain_ip_in_account(session, domain, account_name, account_data['token']))
+        for account_name, account_data in api_configs.items()
+    }
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.result():
+                    return task.result()
+    finally:
+        # Other accounts are not needed after a hit
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+    return None
+
+def get_domain_ip(domain, api_configs):
+    """Getting IP for a specific domain"""
+    # First searching in local SQLite index, results.txt if there is no index yet
+    try:
+        row = find_in_results_db(domain.lower())
+    except sqlite3.Error:
+        row = find_in_results_file(domain)
+
+    if row:
+        # Return format: domain - IP (Account: account)
+        ip, account = row
+        return f"{domain} - {ip} (Account: {account})"
+
+    # If not found in local file, search via API
+    return run(search_domain_ip_via_api(domain, api_configs))
+
 def main():
     # Parsing command line arguments
     parser = argparse.ArgumentParser(description='Cloudflare Domain IP Search')
     parser.add_argument('-d', '--domain', help='Domain to check')
     parser.add_argument('-u', '--update', action='store_true', help='Update domain database')
+    parser.add_argument('-i', '--incremental', action='store_true',
+                        help='Only with -u: request DNS records only for zones whose modified_on changed '
+                             'since the last update. Cloudflare does not always change modified_on when '
+                             'DNS records change, so IPs may be stale; run a plain -u for a full update '
+                             '(interactive mode always does a full update)')
     
     args = parser.parse_args()
+    if args.incremental and not args.update:
+        parser.error('-i/--incremental can only be used with -u/--update')
 
     # Loading API configurations
     api_configs = load_api_configs()
@@ -198,7 +498,7 @@ def main():
     
     elif args.update:
         start_time = time.time()
-        export_dns_records(api_configs)
+        export_dns_records(api_configs, incremental=args.incremental)
         print(f"Execution time: {time.time() - start_time:.2f} seconds")
     
     # If no arguments - run interactive mode
@@ -234,4 +534,7 @@ def main():
                 print("Invalid choice. Try again.")
 
 if __name__ == "__main__":
-    main()
+    try:
+        main()
+    finally:
+        close_session()